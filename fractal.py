@@ -3,40 +3,179 @@ import numpy as np
 import SimpleITK as sitk
 import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from tqdm import tqdm
 
-def fractal_dimension_3D(array, max_box_size=None, min_box_size=1, n_samples=20, n_offsets=0, plot=False):
+try:
+    from numba import get_num_threads, njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+def _box_lookup(size, scale, offset):
+    """Box index of every position along one axis of the grid with edges [-offset, offset, scale + offset, ...]
+
+    Binning follows np.histogramdd: the last edge is inclusive and positions beyond it get -1.
+    """
+    edges = np.hstack([0 - offset, np.arange(0, size, scale) + offset])
+    positions = np.arange(size)
+    lookup = np.searchsorted(edges, positions, side='right') - 1
+    lookup[positions == edges[-1]] -= 1
+    lookup[(positions < edges[0]) | (positions > edges[-1])] = -1
+    return lookup
+
+def _box_lookups(shape, scales, offsets):
+    """Per-axis lookup tables for every (scale, offset) pair, padded to the longest axis"""
+    lookups = np.full((len(scales), offsets.shape[1], len(shape), max(shape)), -1, dtype=np.int32)
+    for i, scale in enumerate(scales):
+        for j, offset in enumerate(offsets[i]):
+            for axis, size in enumerate(shape):
+                lookups[i, j, axis, :size] = _box_lookup(size, scale, offset)
+    return lookups
+
+def _pack_keys(idx):
+    """Pack 3D box indices into one int64 key per voxel (21 bits per axis)"""
+    idx = idx.astype(np.int64)
+    return (idx[0] << 42) | (idx[1] << 21) | idx[2]
+
+def _unpack_keys(keys):
+    """Inverse of _pack_keys"""
+    mask = (1 << 21) - 1
+    return np.stack([keys >> 42, (keys >> 21) & mask, keys & mask])
+
+def _count_unique(keys):
+    """Number of distinct keys, by sorting and counting runs of equal values"""
+    if keys.size == 0:
+        return 0
+    keys = np.sort(keys)
+    return 1 + np.count_nonzero(keys[1:] != keys[:-1])
 
+def _box_count_dyadic(voxels, shape, max_level):
+    """Number of touched boxes at every scale 2**k for k = 0..max_level, without offsets
+
+    Along each axis a voxel only needs (v >> k, whether v is a multiple of 2**k) to be binned at
+    scale 2**k, and that state follows from the one at level k - 1. Coarsening the set of distinct
+    states level by level means only the first level touches every voxel (Molteno 1993).
+    """
+    # states hold (v >> k) << 1 | (v % 2**k != 0) per axis
+    states = voxels.T.astype(np.int64) << 1
+    counts = []
+    for level in range(max_level + 1):
+        if level > 0:
+            floor, remainder = states >> 1, states & 1
+            states = ((floor >> 1) << 1) | remainder | (floor & 1)
+            keys = np.sort(_pack_keys(states))
+            states = _unpack_keys(keys[np.r_[True, keys[1:] != keys[:-1]]])
+        # same binning as _box_lookup: the last edge is inclusive, anything past it is dropped
+        n_bins = np.array([len(np.arange(0, size, 2 ** level)) for size in shape])[:, None]
+        floor, remainder = states >> 1, states & 1
+        on_last_edge = (floor == n_bins - 1) & (remainder == 0)
+        idx = np.where(on_last_edge, n_bins - 1, floor + 1)
+        inside = np.all((floor < n_bins - 1) | on_last_edge, axis=0)
+        counts.append(_count_unique(_pack_keys(idx[:, inside])))
+    return np.array(counts)
+
+def _box_count_vectorised(voxels, lookups):
+    """Number of touched boxes for every (scale, offset) pair, vectorised over the scales"""
+    counts = np.zeros(lookups.shape[:2], dtype=np.int64)
+    if len(voxels) == 0:
+        return counts
+    for j in range(lookups.shape[1]):
+        # box indices of every voxel at every scale at once, shape (3, n_scales, N)
+        idx = np.stack([lookups[:, j, axis][:, voxels[:, axis]] for axis in range(3)])
+        keys = _pack_keys(idx)
+        # a -1 (outside the grid) on any axis makes the packed key negative, so clamping
+        # in place gives those voxels one shared sentinel key that sorts first
+        np.maximum(keys, -1, out=keys)
+        keys.sort(axis=1)
+        counts[:, j] = 1 + np.count_nonzero(keys[:, 1:] != keys[:, :-1], axis=1) - (keys[:, 0] == -1)
+    return counts
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _box_count(voxels, lookups):
+        """Number of touched boxes for every (scale, offset) pair, one scale per thread
+
+        Packed box keys go into an open-addressing hash set sized to the number of possible boxes,
+        so counting is a single O(N) pass and coarse scales work in a small, cache-resident table.
+        """
+        n_scales, n_offsets = lookups.shape[0], lookups.shape[1]
+        counts = np.zeros((n_scales, n_offsets), dtype=np.int64)
+        for i in prange(n_scales):
+            for j in range(n_offsets):
+                # at least twice as many slots as keys that can be distinct
+                n_boxes = 1
+                for axis in range(3):
+                    n_boxes *= lookups[i, j, axis].max() + 1
+                size = 1
+                while size < 2 * min(n_boxes, voxels.shape[0]):
+                    size <<= 1
+                table = np.full(size, -1, dtype=np.int64)
+                touched = 0
+                for v in range(voxels.shape[0]):
+                    b0 = lookups[i, j, 0, voxels[v, 0]]
+                    b1 = lookups[i, j, 1, voxels[v, 1]]
+                    b2 = lookups[i, j, 2, voxels[v, 2]]
+                    if b0 < 0 or b1 < 0 or b2 < 0:
+                        continue
+                    key = (np.int64(b0) << 42) | (np.int64(b1) << 21) | b2
+                    # Fibonacci hashing, then linear probing
+                    slot = ((key * -7046029254386353131) >> 32) & (size - 1)
+                    while table[slot] != -1 and table[slot] != key:
+                        slot = (slot + 1) & (size - 1)
+                    if table[slot] == -1:
+                        table[slot] = key
+                        touched += 1
+                counts[i, j] = touched
+        return counts
+else:
+    _box_count = None
+
+def limit_worker_threads(workers):
+    """Pool initializer giving each of `workers` processes an equal share of Numba's threads"""
+    if njit is not None:
+        set_num_threads(max(1, get_num_threads() // workers))
+
+def _scales_and_offsets(shape, max_box_size, min_box_size, n_samples, n_offsets):
+    """Box sizes to sample and the grid offsets to search over at each of them"""
     if max_box_size == None:
-        max_box_size = int(np.floor(np.log2(np.min(array.shape))))
+        max_box_size = int(np.floor(np.log2(np.min(shape))))
         
-    scales = np.floor(np.logspace(max_box_size, min_box_size, num=n_samples, base=2))
-    scales = np.unique(scales)  # remove duplicates that could occur as a result of the floor
+    # integer box sizes, so the dyadic check and the bin edges are exact
+    exponents = np.linspace(max_box_size, min_box_size, n_samples)
+    scales = np.unique(np.floor(2.0 ** exponents).astype(np.int64))  # remove duplicates that could occur as a result of the floor
 
-    # get the locations of all non-zero pixels
-    locs = np.where(array > 0)
-    voxels = np.array([(x, y, z) for x, y, z in zip(*locs)])
+    if n_offsets == 0:
+        offsets = np.zeros((len(scales), 1))
+    else:
+        offsets = np.linspace(0, scales, n_offsets, axis=1)
+    return scales, offsets
 
-    # count the minimum amount of boxes touched
-    Ns = []
-    
-    # loop over all scales
-    for scale in scales:
-        touched = []
-        if n_offsets == 0:
-            offsets = [0]
-        else:
-            offsets = np.linspace(0, scale, n_offsets)
-        # search over all offsets
-        for offset in offsets:
-            bin_edges = [np.arange(0, i, scale) for i in array.shape]
-            bin_edges = [np.hstack([0 - offset, x + offset]) for x in bin_edges]
-            H1, e = np.histogramdd(voxels, bins=bin_edges)
-            touched.append(np.sum(H1 > 0))
-        Ns.append(touched)
-    Ns = np.array(Ns)
+@lru_cache(maxsize=32)
+def _box_grid(shape, max_box_size, min_box_size, n_samples, n_offsets):
+    """Scales, offsets and lookup tables for a volume shape, cached as batches share shapes"""
+    scales, offsets = _scales_and_offsets(shape, max_box_size, min_box_size, n_samples, n_offsets)
+    lookups = _box_lookups(shape, scales, offsets)
+    # the arrays are shared between calls
+    for a in (scales, offsets, lookups):
+        a.flags.writeable = False
+    return scales, offsets, lookups
 
+@lru_cache(maxsize=32)
+def _box_grid_gpu(shape, max_box_size, min_box_size, n_samples, n_offsets):
+    """_box_grid with the lookup tables on the GPU, so each shape is uploaded once per process"""
+    scales, offsets, lookups = _box_grid(shape, max_box_size, min_box_size, n_samples, n_offsets)
+    return scales, offsets, cp.asarray(lookups)
+
+def _fit_dimension(scales, Ns, plot=False):
+    """Slope of the log-log fit of touched boxes against scale, given counts per (scale, offset)"""
     Ns = Ns.min(axis=1)
 
     scales = np.array([np.min(scales[Ns == x]) for x in np.unique(Ns)])
@@ -62,30 +201,86 @@ def fractal_dimension_3D(array, max_box_size=None, min_box_size=1, n_samples=20,
 
     return coeffs[0]
 
-def process_folder(input_dir, output_json):
+def fractal_dimension_3D(array, max_box_size=None, min_box_size=1, n_samples=20, n_offsets=0, plot=False):
+
+    scales, _, lookups = _box_grid(array.shape, max_box_size, min_box_size, n_samples, n_offsets)
+
+    # get the locations of all non-zero pixels, bool masks need no comparison temporary
+    locs = np.nonzero(array if array.dtype == bool else array > 0)
+    # int32 coordinates halve the memory traffic of the gathers below
+    voxels = np.column_stack(locs).astype(np.int32)
+
+    # count the minimum amount of boxes touched
+    if _box_count is not None:
+        Ns = _box_count(voxels, lookups)
+    elif n_offsets == 0 and np.all((scales & (scales - 1)) == 0):
+        # without Numba, power-of-two scales are counted in one coarsening pass
+        levels = np.log2(scales).astype(int)
+        Ns = _box_count_dyadic(voxels, array.shape, levels.max())[levels, None]
+    else:
+        Ns = _box_count_vectorised(voxels, lookups)
+
+    return _fit_dimension(scales, Ns, plot)
+
+def fractal_dimension_3D_gpu(array, max_box_size=None, min_box_size=1, n_samples=20, n_offsets=0, plot=False):
+    """fractal_dimension_3D for a cupy array, with the box counting done on the GPU"""
+    if cp is None:
+        raise ImportError("CuPy is required for GPU box counting")
+
+    # the lookup tables are small, they are built on the host and uploaded once per shape
+    scales, offsets, lookups = _box_grid_gpu(array.shape, max_box_size, min_box_size, n_samples, n_offsets)
+
+    voxels = cp.stack(cp.nonzero(array if array.dtype == bool else array > 0), axis=1).astype(cp.int32)
+
+    Ns = np.zeros(offsets.shape, dtype=np.int64)
+    for i in range(len(scales)):
+        for j in range(offsets.shape[1]):
+            idx = cp.stack([lookups[i, j, axis][voxels[:, axis]] for axis in range(3)])
+            # voxels outside the grid get one shared sentinel key, as in _box_count_vectorised
+            keys = cp.sort(cp.maximum(_pack_keys(idx), -1))
+            if keys.size > 0:
+                Ns[i, j] = 1 + int(cp.count_nonzero(keys[1:] != keys[:-1])) - int(keys[0] == -1)
+
+    return _fit_dimension(scales, Ns, plot)
+
+def _process_file(nifti_file, use_gpu=False):
+    """Fractal dimension of a single .nii.gz segmentation"""
+    # Read the image
+    image = sitk.ReadImage(str(nifti_file))
+    array = sitk.GetArrayFromImage(image)
+    
+    # Calculate fractal dimension
+    if use_gpu:
+        return fractal_dimension_3D_gpu(cp.asarray(array), plot=False)
+    return fractal_dimension_3D(array, plot=False)
+
+def process_folder(input_dir, output_json, use_gpu=False, workers=None):
     """Process all .nii.gz files in a folder and calculate their fractal dimensions"""
+    if use_gpu and cp is None:
+        raise ImportError("CuPy is required for GPU box counting")
+    if workers is None:
+        # GPU workers would each open a CUDA context and upload volumes to the same device
+        workers = 1 if use_gpu else max(1, (os.cpu_count() or 2) // 2)
+
     input_path = Path(input_dir)
     results = {}
     
     # Get all .nii.gz files
     nifti_files = list(input_path.glob('*.nii.gz'))
     
-    # Process each file with a progress bar
-    for nifti_file in tqdm(nifti_files, desc="Processing files"):
-        try:
-            # Read the image
-            image = sitk.ReadImage(str(nifti_file))
-            array = sitk.GetArrayFromImage(image)
-            
-            # Calculate fractal dimension
-            fd = fractal_dimension_3D(array, plot=False)
-            
-            # Store result using filename without extension as key
-            case_number = nifti_file.stem.replace('.nii', '')
-            results[case_number] = float(fd)  # Convert to float for JSON serialization
-            
-        except Exception as e:
-            print(f"Error processing {nifti_file.name}: {str(e)}")
+    # Process the files in parallel with a progress bar, splitting the cores between processes and Numba threads
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_worker_threads, initargs=(workers,)) as executor:
+        futures = [executor.submit(_process_file, nifti_file, use_gpu) for nifti_file in nifti_files]
+        for nifti_file, future in tqdm(zip(nifti_files, futures), total=len(futures), desc="Processing files"):
+            try:
+                fd = future.result()
+                
+                # Store result using filename without extension as key
+                case_number = nifti_file.stem.replace('.nii', '')
+                results[case_number] = float(fd)  # Convert to float for JSON serialization
+                
+            except Exception as e:
+                print(f"Error processing {nifti_file.name}: {str(e)}")
     
     # Save results to JSON file
     with open(output_json, 'w') as f:
@@ -99,11 +294,15 @@ def main():
     parser.add_argument('input_dir', type=str, help='Directory containing .nii.gz files')
     parser.add_argument('--output', type=str, default='fractal_dimensions.json',
                         help='Output JSON file path (default: fractal_dimensions.json)')
+    parser.add_argument('--gpu', action='store_true',
+                        help='Count boxes on the GPU (requires CuPy)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: half the CPU count, 1 with --gpu)')
     
     args = parser.parse_args()
     
     # Process the folder
-    results = process_folder(args.input_dir, args.output)
+    results = process_folder(args.input_dir, args.output, use_gpu=args.gpu, workers=args.workers)
     
     # Print summary
     print(f"\nProcessed {len(results)} files")
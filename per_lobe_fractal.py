@@ -1,13 +1,77 @@
-import SimpleITK as sitk
+import nibabel as nib
 import os
 import numpy as np
 import glob
-from fractal import fractal_dimension_3D
+from fractal import fractal_dimension_3D, fractal_dimension_3D_gpu, limit_worker_threads
 from tqdm import tqdm
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Lobes with fewer airway voxels than this are recorded as NaN
+MIN_VOXELS = 100
+
+def process_patient(patient_id, airway_file, lobe_file, use_gpu=False):
+    """Calculate the fractal dimension of the airways in each lobe of one patient"""
+    xp = cp if use_gpu else np
+
+    print(f"\nProcessing {patient_id}")
+    
+    # Read each volume once through nibabel's array proxy
+    airway_array = np.asarray(nib.load(airway_file).dataobj, dtype=np.uint8)
+    lobe_array = np.asarray(nib.load(lobe_file).dataobj, dtype=np.uint8)
+    
+    if use_gpu:
+        # upload both volumes once and reuse them for every lobe
+        airway_array = cp.asarray(airway_array)
+        lobe_array = cp.asarray(lobe_array)
+    
+    # Lobe labels at the airway voxels only, the airways are a small fraction of the volume.
+    # nibabel arrays are Fortran-ordered, a boolean mask avoids the C-order copies ravel() would make
+    airway_mask = airway_array > 0
+    labels_at_airway = lobe_array[airway_mask]
+    
+
+    patient_results = {
+        "patient_id": patient_id,
+        "lobes": {}
+    }
+    
+    # Get unique lobe labels 
+    unique_lobes = xp.unique(labels_at_airway)
+    unique_lobes = unique_lobes[unique_lobes != 0]
+    
+    # Calculate fractal dimension for each lobe
+    for lobe_label in unique_lobes:
+        in_lobe = labels_at_airway == lobe_label
+        n_voxels = int(in_lobe.sum())
+        if n_voxels < MIN_VOXELS:
+            patient_results["lobes"][f"lobe_{lobe_label}"] = float('nan')
+            print(f"Lobe {lobe_label} -> only {n_voxels} airway voxels, skipped")
+            continue
+        mask_lobe = xp.zeros(airway_array.shape, dtype=bool)
+        mask_lobe[airway_mask] = in_lobe
+        if use_gpu:
+            fd = float(fractal_dimension_3D_gpu(mask_lobe))
+        else:
+            fd = float(fractal_dimension_3D(mask_lobe))
+        patient_results["lobes"][f"lobe_{lobe_label}"] = fd
+        print(f"Lobe {lobe_label} -> Fractal Dimension: {fd:.3f}")
+    
+    return patient_results
+
+def calculate_lobe_fractals(airway_directory, lobe_directory, output_file, use_gpu=False, workers=None):
+    if use_gpu and cp is None:
+        raise ImportError("CuPy is required for GPU box counting")
+    if workers is None:
+        # GPU workers would each open a CUDA context and upload volumes to the same device
+        workers = 1 if use_gpu else max(1, (os.cpu_count() or 2) // 2)
 
-def calculate_lobe_fractals(airway_directory, lobe_directory, output_file):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
     # Find all airway segmentation files with RBH prefix
@@ -17,49 +81,25 @@ def calculate_lobe_fractals(airway_directory, lobe_directory, output_file):
 
     all_results = []
     
-
-    for airway_file in tqdm(airway_files, desc="Processing cases"):
-        patient_id = os.path.basename(airway_file).split('.')[0]
-        lobe_file = os.path.join(lobe_directory, patient_id, f"{patient_id}_lobes.nii.gz")
-       
-        if not os.path.exists(lobe_file):
-            print(f"WARNING: Lobe segmentation not found for {patient_id}, skipping")
-            continue
-        
-        print(f"\nProcessing {patient_id}")
-        
-        try:
-            airway_image = sitk.ReadImage(airway_file, sitk.sitkUInt8)
-            lobe_image = sitk.ReadImage(lobe_file, sitk.sitkUInt8)
-            
-            airway_array = sitk.GetArrayFromImage(airway_image)
-            lobe_array = sitk.GetArrayFromImage(lobe_image)
-            
-            airway_lobe_np = lobe_array * airway_array
+    # Patients are independent, so process them in parallel, splitting the cores between processes and Numba threads
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_worker_threads, initargs=(workers,)) as executor:
+        futures = {}
+        for airway_file in airway_files:
+            patient_id = os.path.basename(airway_file).split('.')[0]
+            lobe_file = os.path.join(lobe_directory, patient_id, f"{patient_id}_lobes.nii.gz")
+           
+            if not os.path.exists(lobe_file):
+                print(f"WARNING: Lobe segmentation not found for {patient_id}, skipping")
+                continue
             
+            futures[patient_id] = executor.submit(process_patient, patient_id, airway_file, lobe_file, use_gpu)
 
-            patient_results = {
-                "patient_id": patient_id,
-                "lobes": {}
-            }
-            
-            # Get unique lobe labels 
-            unique_lobes = np.unique(airway_lobe_np)
-            unique_lobes = unique_lobes[unique_lobes != 0]
-            
-            # Calculate fractal dimension for each lobe
-            for lobe_label in unique_lobes:
-                mask_lobe = (airway_lobe_np == lobe_label)
-                fd = float(fractal_dimension_3D(mask_lobe))
-                patient_results["lobes"][f"lobe_{lobe_label}"] = fd
-                print(f"Lobe {lobe_label} -> Fractal Dimension: {fd:.3f}")
-            
-
-            all_results.append(patient_results)
-            
-        except Exception as e:
-            print(f"Error processing {patient_id}: {str(e)}")
-            continue
+        for patient_id, future in tqdm(futures.items(), desc="Processing cases"):
+            try:
+                all_results.append(future.result())
+            except Exception as e:
+                print(f"Error processing {patient_id}: {str(e)}")
+                continue
     
     # Save results to JSON file
     with open(output_file, 'w') as f:
@@ -82,6 +122,12 @@ def parse_args():
     parser.add_argument('--output', type=str, default="results/per_lobe_fractal_dimensions.json",
                        help='Output JSON file to save results')
     
+    parser.add_argument('--gpu', action='store_true',
+                       help='Count boxes on the GPU (requires CuPy)')
+    
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of worker processes (default: half the CPU count, 1 with --gpu)')
+    
     return parser.parse_args()
 
 def main():
@@ -91,7 +137,7 @@ def main():
     print(f"Lobe segmentation directory: {args.lobe_dir}")
     print(f"Output file: {args.output}")
     
-    calculate_lobe_fractals(args.airway_dir, args.lobe_dir, args.output)
+    calculate_lobe_fractals(args.airway_dir, args.lobe_dir, args.output, use_gpu=args.gpu, workers=args.workers)
 
 if __name__ == "__main__":
     main() 
@@ -1,27 +1,110 @@
 #!/usr/bin/env python3
-import SimpleITK as sitk
+import nibabel as nib
 import os
 import numpy as np
 import glob
 from tqdm import tqdm
 from skimage.morphology import skeletonize
-from skan import Skeleton, summarize
+from skan import Skeleton
+from batch_tortuosity import branch_endpoints, branch_tortuosity, skeletonize_slices
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-def compute_tortuosity(df, length_threshold=1e-6):
-    xyz_start = df[['coord-src-0', 'coord-src-1', 'coord-src-2']].to_numpy()
-    xyz_end   = df[['coord-dst-0', 'coord-dst-1', 'coord-dst-2']].to_numpy()
-    euclid = np.linalg.norm(xyz_start - xyz_end, axis=1)
-    df = df.copy()
-    df["euclid-length"] = euclid
-    df_tort = df[df["euclid-length"] > length_threshold].copy()
-    df_tort["tortuosity"] = df_tort["branch-distance"] / df_tort["euclid-length"]
-    global_tort_weighted = (df_tort["branch-distance"] * df_tort["tortuosity"]).sum() / df_tort["branch-distance"].sum()
-    global_tort_simple   = df_tort["tortuosity"].mean()
-    return global_tort_simple, global_tort_weighted
+# Lobes with fewer airway voxels than this are recorded as NaN
+MIN_VOXELS = 100
+
+def _branch_lobes(skel, lobe_array):
+    """Lobe label holding most of the voxels of each branch of a skan Skeleton"""
+    n_branches, n_labels = skel.paths.shape[0], int(lobe_array.max()) + 1
+    # one (branch, label) vote per path voxel
+    branch_ids = np.repeat(np.arange(n_branches), np.diff(skel.paths.indptr))
+    voxel_labels = lobe_array[tuple(skel.coordinates[skel.paths.indices].astype(np.intp).T)]
+    votes = np.bincount(branch_ids * n_labels + voxel_labels, minlength=n_branches * n_labels)
+    return votes.reshape(n_branches, n_labels).argmax(axis=1)
+
+def process_patient(patient_id, airway_file, lobe_file, slice_skeleton=False):
+    """Calculate the tortuosity of the airways in each lobe of one patient"""
+    print(f"\nProcessing {patient_id}")
+    
+    # Load the airway and lobe segmentation images
+    airway_image = nib.load(airway_file)
+    airway_array = np.asarray(airway_image.dataobj, dtype=np.uint8)
+    lobe_array = np.asarray(nib.load(lobe_file).dataobj, dtype=np.uint8)
+    
+    patient_results = {
+        "patient_id": patient_id,
+        "lobes": {}
+    }
+    
+    # Number of airway voxels in each lobe
+    airway_mask = airway_array.astype(bool)
+    airway_voxels_per_lobe = np.bincount(lobe_array[airway_mask])
+    
+    # Skeletonise the whole airway tree once
+    spacing = airway_image.header.get_zooms()[:3]
+    if slice_skeleton:
+        skeleton_full = skeletonize_slices(airway_mask, axis=2)
+    else:
+        skeleton_full = skeletonize(airway_mask)
+    
+    # Measure every branch of the tree in one pass, each branch belongs to the lobe holding most of its voxels
+    if skeleton_full.any():
+        s = Skeleton(skeleton_full, spacing=spacing)
+        src, dst = branch_endpoints(s)
+        branch_distance = s.path_lengths()
+        tortuosity, keep = branch_tortuosity(src * s.spacing, dst * s.spacing, branch_distance)
+        branch_distance = branch_distance[keep]
+        labels = _branch_lobes(s, lobe_array)[keep]
+    else:
+        branch_distance = tortuosity = np.zeros(0)
+        labels = np.zeros(0, dtype=np.intp)
+    
+    # Sum the branches of each lobe with one reduction over the branches sorted by lobe
+    order = np.argsort(labels, kind='stable')
+    labels, branch_distance, tortuosity = labels[order], branch_distance[order], tortuosity[order]
+    branch_lobe_labels, starts, n_branches = np.unique(labels, return_index=True, return_counts=True)
+    mean_tort_per_lobe = np.add.reduceat(tortuosity, starts) / n_branches
+    weighted_tort_per_lobe = np.add.reduceat(branch_distance * tortuosity, starts) / np.add.reduceat(branch_distance, starts)
+    lobe_rows = {label: row for row, label in enumerate(branch_lobe_labels)}
+    
+    # Get lobe labels that contain airway (excluding background)
+    unique_lobes = np.flatnonzero(airway_voxels_per_lobe)
+    unique_lobes = unique_lobes[unique_lobes != 0]
+    
+    # Calculate tortuosity for each lobe
+    for lobe_label in unique_lobes:
+        if airway_voxels_per_lobe[lobe_label] < MIN_VOXELS:
+            patient_results["lobes"][f"lobe_{lobe_label}"] = {
+                "mean_tortuosity": float('nan'),
+                "weighted_tortuosity": float('nan')
+            }
+            print(f"Lobe {lobe_label} -> only {airway_voxels_per_lobe[lobe_label]} airway voxels, skipped")
+            continue
+    
+        if lobe_label not in lobe_rows:
+            patient_results["lobes"][f"lobe_{lobe_label}"] = {
+                "mean_tortuosity": float('nan'),
+                "weighted_tortuosity": float('nan')
+            }
+            print(f"Lobe {lobe_label} -> no skeleton branches, skipped")
+            continue
+    
+        mean_tort = mean_tort_per_lobe[lobe_rows[lobe_label]]
+        weighted_tort = weighted_tort_per_lobe[lobe_rows[lobe_label]]
+    
+        patient_results["lobes"][f"lobe_{lobe_label}"] = {
+            "mean_tortuosity": float(mean_tort),
+            "weighted_tortuosity": float(weighted_tort)
+        }
+        print(f"Lobe {lobe_label} -> Mean Tortuosity: {mean_tort:.3f}, Weighted Tortuosity: {weighted_tort:.3f}")
+    
+    return patient_results
+
+def calculate_lobe_tortuosity(airway_directory, lobe_directory, output_file, slice_skeleton=False, workers=None):
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) // 2)
 
-def calculate_lobe_tortuosity(airway_directory, lobe_directory, output_file):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
     # Find all airway segmentation files with RBH prefix
@@ -30,78 +113,25 @@ def calculate_lobe_tortuosity(airway_directory, lobe_directory, output_file):
     
     all_results = []
 
-    for airway_file in tqdm(airway_files, desc="Processing cases"):
-        patient_id = os.path.basename(airway_file).split('.')[0]
-        lobe_file = os.path.join(lobe_directory, patient_id, f"{patient_id}_lobes.nii.gz")
-        
-        if not os.path.exists(lobe_file):
-            print(f"WARNING: Lobe segmentation not found for {patient_id}, skipping")
-            continue
-        
-        print(f"\nProcessing {patient_id}")
-        
-        # Load the airway and lobe segmentation images
-        try:
-            airway_image = sitk.ReadImage(airway_file, sitk.sitkUInt8)
-            lobe_image = sitk.ReadImage(lobe_file, sitk.sitkUInt8)
-            
+    # Patients are independent, so process them in parallel
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for airway_file in airway_files:
+            patient_id = os.path.basename(airway_file).split('.')[0]
+            lobe_file = os.path.join(lobe_directory, patient_id, f"{patient_id}_lobes.nii.gz")
             
-            airway_array = sitk.GetArrayFromImage(airway_image)
-            lobe_array = sitk.GetArrayFromImage(lobe_image)
-            
-      
-            airway_lobe_np = lobe_array * airway_array
+            if not os.path.exists(lobe_file):
+                print(f"WARNING: Lobe segmentation not found for {patient_id}, skipping")
+                continue
             
+            futures[patient_id] = executor.submit(process_patient, patient_id, airway_file, lobe_file, slice_skeleton)
 
-            patient_results = {
-                "patient_id": patient_id,
-                "lobes": {}
-            }
-            
-            # Get unique lobe labels (excluding background)
-            unique_lobes = np.unique(airway_lobe_np)
-            unique_lobes = unique_lobes[unique_lobes != 0]
-            
-            # Calculate tortuosity for each lobe
-            for lobe_label in unique_lobes:
-       
-                mask_lobe = (airway_lobe_np == lobe_label)
-                
-       
-                if not np.any(mask_lobe):
-                    continue
-                
- 
-                spacing = airway_image.GetSpacing()
-                skeleton = skeletonize(mask_lobe)
-                s = Skeleton(skeleton, spacing=spacing)
-                df = summarize(s)
-                
-                if 'coord-src-0' not in df.columns:
-                    df = df.rename(columns={
-                        'coord_src_0': 'coord-src-0',
-                        'coord_src_1': 'coord-src-1',
-                        'coord_src_2': 'coord-src-2',
-                        'coord_dst_0': 'coord-dst-0',
-                        'coord_dst_1': 'coord-dst-1',
-                        'coord_dst_2': 'coord-dst-2',
-                        'branch_distance': 'branch-distance',
-                    })
-                
-                # Calculate tortuosity
-                mean_tort, weighted_tort = compute_tortuosity(df)
-                
-                patient_results["lobes"][f"lobe_{lobe_label}"] = {
-                    "mean_tortuosity": float(mean_tort),
-                    "weighted_tortuosity": float(weighted_tort)
-                }
-                print(f"Lobe {lobe_label} -> Mean Tortuosity: {mean_tort:.3f}, Weighted Tortuosity: {weighted_tort:.3f}")
-            
-            all_results.append(patient_results)
-            
-        except Exception as e:
-            print(f"Error processing {patient_id}: {str(e)}")
-            continue
+        for patient_id, future in tqdm(futures.items(), desc="Processing cases"):
+            try:
+                all_results.append(future.result())
+            except Exception as e:
+                print(f"Error processing {patient_id}: {str(e)}")
+                continue
     
     # Save results to JSON file
     with open(output_file, 'w') as f:
@@ -124,6 +154,12 @@ def parse_args():
     parser.add_argument('--output', type=str, default="results/per_lobe_tortuosity.json",
                        help='Output JSON file to save results')
     
+    parser.add_argument('--slice_skeleton', action='store_true',
+                       help='Skeletonise slice by slice in 2D instead of in 3D (faster, less accurate)')
+    
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of worker processes (default: half the CPU count)')
+    
     return parser.parse_args()
 
 def main():
@@ -133,7 +169,7 @@ def main():
     print(f"Lobe segmentation directory: {args.lobe_dir}")
     print(f"Output file: {args.output}")
     
-    calculate_lobe_tortuosity(args.airway_dir, args.lobe_dir, args.output)
+    calculate_lobe_tortuosity(args.airway_dir, args.lobe_dir, args.output, args.slice_skeleton, args.workers)
 
 if __name__ == "__main__":
     main()